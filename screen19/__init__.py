@@ -1,16 +1,14 @@
 """Common tools for the I19 module."""
 
 import logging
+import math
 import os
 import re
+import shutil
 import subprocess
 import sys
 import traceback
-from typing import Dict, Tuple  # noqa: F401
-
-import procrunner
-
-# Flake8 does not detect typing yet (https://gitlab.com/pycqa/flake8/issues/342)
+from typing import Tuple
 
 __version__ = "0.213"
 
@@ -21,6 +19,9 @@ debug, info, warn = logger.debug, logger.info, logger.warning
 # Set axis tick positions manually.  Accounts for reciprocal(-square) d-scaling.
 d_ticks = [5, 3, 2, 1.5, 1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4]
 
+# The last contiguous group of numerals (or template hashes) before a file extension.
+_image_number = re.compile(r"([0-9#]+)(?=\.\w)")
+
 
 def terminal_size() -> Tuple[int, int]:
     """
@@ -30,17 +31,8 @@ def terminal_size() -> Tuple[int, int]:
     """
     columns, rows = 80, 25
     if sys.stdout.isatty():
-        try:
-            result = procrunner.run(
-                ["stty", "size"],
-                timeout=1,
-                raise_timeout_exception=True,
-                print_stdout=False,
-                print_stderr=False,
-            )
-            rows, columns = (int(i) for i in result.stdout.decode("utf-8").split())
-        except Exception:  # ignore any errors and use default size
-            pass  # FIXME: Can we be more specific about the type of exception?
+        # Falls back to the default size if the terminal size cannot be determined
+        columns, rows = shutil.get_terminal_size((columns, rows))
     columns = min(columns, 120)
     rows = min(rows, int(columns / 3))
 
@@ -70,9 +62,9 @@ def prettyprint_dictionary(d):
 
 def prettyprint_procrunner(d):
     """
-    Produce a nice string representation of a procrunner ReturnObject, for printing.
+    Produce a nice string representation of a completed subprocess, for printing.
 
-    :param d: ReturnObject to be printed.
+    :param d: subprocess.CompletedProcess to be printed.
     :return: String representation of :param d:.
     :rtype: str
     """
@@ -86,6 +78,27 @@ def prettyprint_procrunner(d):
     )
 
 
+class LazyPrettyPrint:
+    """
+    Defer the pretty-printing of a completed subprocess until it is needed.
+
+    Pass an instance, rather than a formatted string, as a logging argument, e.g.
+    ``debug("result = %s", LazyPrettyPrint(result))``.  The logger only converts it
+    to a string if the record is emitted, so the process output is not reformatted
+    when debug logging is disabled.
+
+    :param d: subprocess.CompletedProcess to be printed.
+    """
+
+    __slots__ = ("d",)
+
+    def __init__(self, d):
+        self.d = d
+
+    def __str__(self):
+        return prettyprint_procrunner(self.d)
+
+
 def make_template(f):
     """
     Generate a xia2-style filename template.
@@ -104,7 +117,7 @@ def make_template(f):
     directory, f = os.path.split(f)
     # Split off the file extension, assuming it begins at the first full stop,
     # also split the last contiguous group of digits off the filename root
-    parts = re.split(r"([0-9#]+)(?=\.\w)", f, 1)
+    parts = _image_number.split(f, 1)
     # Get the number of digits in the group we just isolated and their value
     try:
         # Combine the root, a hash for each digit and the extension
@@ -117,6 +130,58 @@ def make_template(f):
     return os.path.join(directory, template), image
 
 
+def ascii_histogram(
+    bins,
+    hist_value_factor,
+    title="Pixel intensity distribution",
+    xlabel="% of maximum",
+):
+    """
+    Create an ASCII art histogram of intensities, without recourse to gnuplot.
+
+    As with :func:`plot_intensities`, the vertical axis has a logarithmic scale.
+    Where several bins share a column of the plot, the largest count is shown.
+
+    :param bins: Histogram, as a dictionary of bin index to count.
+    :param hist_value_factor: Factor to convert a bin index to an x-axis value.
+    :param title: Title of the plot.
+    :param xlabel: Label of the x-axis.
+    """
+    if not bins:
+        return
+    columns, rows = terminal_size()
+
+    y_max = max(bins.values())
+    x_max = max(bins) * hist_value_factor or 1
+    # Leave room for the y-axis labels, the title and the x-axis.
+    label_width = len(str(y_max))
+    width = max(columns - label_width - 2, 1)
+    height = max(rows - 6, 3)
+
+    peaks = [0] * width
+    for x, count in bins.items():
+        column = round(x * hist_value_factor / x_max * (width - 1))
+        peaks[column] = max(peaks[column], count)
+    # The bottom row stands for a single count, the top row for the largest count.
+    log_max = math.log10(y_max) or 1
+    levels = [
+        1 + round((height - 1) * math.log10(peak) / log_max) if peak else 0
+        for peak in peaks
+    ]
+
+    info(title.center(columns))
+    for row in range(height, 0, -1):
+        label = str(y_max) if row == height else "1" if row == 1 else ""
+        info(
+            "%s |%s",
+            label.rjust(label_width),
+            "".join("*" if level >= row else " " for level in levels),
+        )
+    info("%s +%s", " " * label_width, "-" * width)
+    info("%s0%s", " " * (label_width + 2), f"{x_max:g}".rjust(width - 1))
+    info(xlabel.center(columns))
+
+
 def plot_intensities(
     bins,
     hist_value_factor,
@@ -151,21 +216,24 @@ def plot_intensities(
         "set ytics out",
         "plot '-' using 1:2 title '' %s" % style,
     ]
-    for x in sorted(bins.keys()):
-        plot_commands.append("%f %d" % (x * hist_value_factor, bins[x]))
+    plot_commands += [
+        "%f %d" % (x * hist_value_factor, count) for x, count in sorted(bins.items())
+    ]
     plot_commands.append("e")
+    # Join with a trailing newline and encode in one pass, with no bytes concatenation
+    script = "\n".join([*plot_commands, ""]).encode("utf-8")
 
-    debug("running %s with:\n  %s\n", " ".join(command), "\n  ".join(plot_commands))
+    if logger.isEnabledFor(logging.DEBUG):
+        debug("running %s with:\n  %s\n", " ".join(command), "\n  ".join(plot_commands))
 
     try:
-        result = procrunner.run(
+        result = subprocess.run(
             command,
-            stdin="\n".join(plot_commands).encode("utf-8") + b"\n",
+            input=script,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             timeout=120,
-            raise_timeout_exception=True,
-            print_stdout=False,
-            print_stderr=False,
-            environment_override={"LD_LIBRARY_PATH": ""},
+            env=dict(os.environ, LD_LIBRARY_PATH=""),
         )
     except (OSError, subprocess.TimeoutExpired):
         info(traceback.format_exc())
@@ -175,7 +243,7 @@ def plot_intensities(
         )
         return
     else:
-        debug("result = %s", prettyprint_procrunner(result))
+        debug("result = %s", LazyPrettyPrint(result))
 
     returncode = getattr(result, "returncode")
     if returncode:
@@ -185,16 +253,17 @@ def plot_intensities(
             returncode,
         )
     else:
-        star = re.compile(r"\*")
+        # Fill in the gaps that gnuplot leaves between the stars of each box.
+        star = ord("*")
         state = set()
-        for line in result.stdout.decode("utf-8").split("\n"):
-            if line.strip() != "":
-                stars = {m.start(0) for m in re.finditer(star, line)}
+        for line in result.stdout.split(b"\n"):
+            if line.strip():
+                stars = {i for i, c in enumerate(line) if c == star}
                 if not stars:
                     state = set()
                 else:
                     state |= stars
-                    line = list(line)
+                    line = bytearray(line)
                     for s in state:
-                        line[s] = "*"
-                info("".join(line))
+                        line[s] = star
+                info(line.decode("utf-8"))
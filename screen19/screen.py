@@ -40,19 +40,22 @@ Examples:
 
 """
 
-import json
 import logging
 import math
 import os
 import re
+import subprocess
 import sys
 import time
 import timeit
+from collections import defaultdict
+from decimal import Decimal
 from glob import glob
 from pickle import PickleError
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
 
-import procrunner
+import ijson
+import numpy as np
 
 import iotbx.phil
 from libtbx import Auto
@@ -65,6 +68,7 @@ from dials.algorithms.indexing import DialsIndexError
 from dials.algorithms.indexing.bravais_settings import (
     refined_settings_from_refined_triclinic,
 )
+from dials.algorithms.profile_model.factory import ProfileModelFactory
 from dials.algorithms.shoebox import MaskCode
 from dials.array_family import flex
 from dials.command_line.dials_import import MetaDataUpdater
@@ -75,6 +79,7 @@ from dials.command_line.refine_bravais_settings import (
     eliminate_sys_absent,
     map_to_primitive,
 )
+from dials.command_line.report import Analyser
 from dials.util import Sorry, log, version
 from dials.util.ascii_art import spot_counts_per_image_plot
 from dials.util.options import OptionParser
@@ -144,6 +149,12 @@ phil_scope = iotbx.phil.parse(
                     "0.25 × the manufacturer's trusted range.  It is therefore "
                     "sensible to present the user with a correspondingly reduced upper-"
                     "limit flux recommendation."
+        gnuplot = False
+            .type = bool
+            .caption = 'Draw the pixel intensity histogram with gnuplot'
+            .help = "By default, screen19 draws the ASCII-art histogram of pixel "
+                    "intensities itself.  Set this to draw it with gnuplot instead, "
+                    "if gnuplot is available."
         }
 
     dials_import
@@ -211,6 +222,9 @@ phil_scope = iotbx.phil.parse(
 logger = logging.getLogger("dials.screen19")
 debug, info, warning = logger.debug, logger.info, logger.warning
 
+# The table of candidate Bravais settings in dials.refine_bravais_settings output.
+_bravais_table = re.compile(r"[-+]{3,}\n[^\n]*\n[-+|]{3,}\n(.*\n)*[-+]{3,}")
+
 
 def _run_integration(
     phil_scope: scope, experiments_file: str, reflections_file: str
@@ -243,6 +257,74 @@ def _run_integration(
     return expts, refls
 
 
+def _average_to_peak_ratio(oscillation: float, sigma_m: float) -> float:
+    """
+    Estimate the ratio of the average to the peak intensity of a reflection on an image.
+
+    The rotation profile of a reflection is modelled as a Gaussian of standard
+    deviation σ_m, of which each image records an oscillation-wide slice.
+
+    Args:
+        oscillation:  Oscillation width of a single image, in degrees.
+        sigma_m:  Standard deviation of the mosaicity, in degrees.
+
+    Returns:
+        The average-to-peak intensity ratio.
+    """
+    delta_z = oscillation / sigma_m / math.sqrt(2)
+    return (
+        math.sqrt(math.pi) * delta_z * math.erf(delta_z) + math.exp(-(delta_z**2)) - 1
+    ) / delta_z**2
+
+
+def _read_overload_data(
+    filename: str,
+) -> Tuple[Dict[int, int], Dict[str, Union[int, Decimal]]]:
+    """
+    Stream the pixel count histogram and its scalar metadata from xia2.overload output.
+
+    The file is parsed incrementally, so that the potentially very large histogram
+    never has to be held in memory as a complete JSON object tree.  If the file
+    contains a list of histogram `bins`, it takes precedence over any `counts`
+    mapping, and only the first `bin_count` bins are used.
+
+    Args:
+        filename:  Path to the JSON output file of xia2.overload.
+
+    Returns:
+        The histogram of positive pixel counts, mapping each count value to the
+        number of pixels; the scalar entries of the file, such as `scale_factor`
+        and `overload_limit`, as parsed by ijson (integers as int, other numbers
+        as Decimal).
+    """
+    bins = None
+    counts = {}
+    scalars = {}
+    bin_index = 0
+    with open(filename, "rb") as fh:
+        for prefix, event, value in ijson.parse(fh):
+            if prefix == "bins" and event == "start_array":
+                bins = {}
+            elif prefix == "bins.item":
+                if value > 0:
+                    bins[bin_index] = int(value)
+                bin_index += 1
+            elif event != "number":
+                continue
+            elif prefix.startswith("counts."):
+                count = int(prefix[len("counts.") :])
+                if count > 0:
+                    counts[count] = int(value)
+            elif "." not in prefix:
+                scalars[prefix] = value
+
+    if bins is None:
+        return counts, scalars
+
+    bin_count = scalars.get("bin_count", bin_index)
+    return {b: v for b, v in bins.items() if b < bin_count}, scalars
+
+
 def overloads_histogram(
     d_spacings: Sequence[float],
     ticks: Optional[Sequence[float]] = None,
@@ -317,25 +399,29 @@ class Screen19:
             # No point in quick-importing a single file
             return False
         debug("Attempting quick import...")
-        files.sort()
-        templates: Dict[str, List[Optional[List[int]]]] = {}
+        # Group the image numbers by template.  Duplicate file names are ignored.
+        images: Dict[str, Set[Optional[int]]] = defaultdict(set)
         for f in files:
             template, image = screen19.make_template(f)
-            if template not in templates:
-                image_range = [image, image] if image else []
-                templates.update({template: [image_range]})
-            elif image == templates[template][-1][-1] + 1:
-                templates[template][-1][-1] = image
-            elif image == templates[template][-1][-1]:
-                # We have a duplicate input file name.  Do nothing.
-                pass
-            else:
-                templates[template].append([image, image])
-        # Return tuple of template and image range for each unique image range
-        templates: Templates = [
-            (t, tuple(r)) for t, ranges in templates.items() for r in ranges
-        ]
-        return self._quick_import_templates(templates)
+            images[template].add(image)
+
+        if len(images) > 1:
+            debug(
+                "Cannot currently run quick import on multiple templates:\n\t%s",
+                sorted(images),
+            )
+            return False
+
+        ((template, numbers),) = images.items()
+        if None in numbers:
+            debug("Cannot run quick import: could not determine image naming template.")
+            return False
+        first, last = min(numbers), max(numbers)
+        if last - first + 1 != len(numbers):
+            debug("Cannot currently run quick import on a non-contiguous image range.")
+            return False
+
+        return self._quick_import_templates([(template, (first, last))])
 
     def _quick_import_templates(self, templates: Templates) -> bool:
         """
@@ -345,18 +431,16 @@ class Screen19:
         the first image file, thereby running more quickly than reading each image
         header individually.
 
+        Only a single template is currently supported.
+
         Args:
-            templates:  A list of tuples, each tuple containing a xia2-style filename
-                        template and the start and end image numbers of the associated
-                        sweep.
+            templates:  A list containing one tuple of a xia2-style filename template
+                        and the start and end image numbers of the associated sweep.
 
         Returns:
             Boolean flag indicating whether the quick import has succeeded.
         """
         debug("Quick import template summary:\n\t%s", templates)
-        if len(templates) > 1:
-            debug("Cannot currently run quick import on multiple templates.")
-            return False
 
         try:
             scan_range: Tuple[int, int] = templates[0][1]
@@ -392,13 +476,13 @@ class Screen19:
                     "that directory."
                 )
                 # TODO Support HDF5.
-                files = [
-                    os.path.join(files[0], f)
-                    for f in os.listdir(files[0])
-                    if f.endswith(".cbf")
-                    or f.endswith(".cbf.gz")
-                    or f.endswith(".cbf.bz2")
-                ]
+                with os.scandir(files[0]) as entries:
+                    files = [
+                        entry.path
+                        for entry in entries
+                        if entry.name.endswith((".cbf", ".cbf.gz", ".cbf.bz2"))
+                        and entry.is_file()
+                    ]
             elif len(files[0].split(":")) == 3:
                 debug(
                     "You specified an image range in the xia2 format.  "
@@ -548,7 +632,12 @@ class Screen19:
         except (ValueError, TypeError):
             pass
 
-        self.nproc = number_of_processors(return_value_if_unknown=-1)
+        try:
+            # Respect any CPU affinity restrictions placed on this process
+            self.nproc = len(os.sched_getaffinity(0))
+        except AttributeError:
+            # os.sched_getaffinity is not available on every platform
+            self.nproc = number_of_processors(return_value_if_unknown=-1)
 
         if self.nproc <= 0:
             warning(
@@ -561,8 +650,8 @@ class Screen19:
         """
         Attempt to determine the number of diffraction images.
 
-        The number of diffraction images is determined from the imported_experiments
-        JSON file.
+        The number of diffraction images is determined from the imageset of the
+        imported experiment list held in memory, so no file need be read.
 
         Returns:
             Number of images.
@@ -591,62 +680,57 @@ class Screen19:
 
         debug("running %s", command)
         start = timeit.default_timer()
-        result = procrunner.run(command, print_stdout=False)
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        debug("result = %s", screen19.prettyprint_procrunner(result))
+        debug("result = %s", screen19.LazyPrettyPrint(result))
         info("Successfully completed (%.1f sec)", timeit.default_timer() - start)
 
         if result.returncode:
-            warning("Failed with exit code %d", result.returncode)
+            warning(
+                "Failed with exit code %d\n%s",
+                result.returncode,
+                result.stderr.decode("utf-8", "replace"),
+            )
             sys.exit(1)
 
-        with open("overload.json") as fh:
-            overload_data = json.load(fh)
+        hist, overload_data = _read_overload_data("overload.json")
+        counts = np.fromiter(hist.keys(), dtype=np.int64, count=len(hist))
+        pixels = np.fromiter(hist.values(), dtype=np.int64, count=len(hist))
 
         info("Pixel intensity distribution:")
-        count_sum = 0
-        hist = {}
-        if "bins" in overload_data:
-            for b in range(overload_data["bin_count"]):
-                if overload_data["bins"][b] > 0:
-                    hist[b] = overload_data["bins"][b]
-                    count_sum += b * overload_data["bins"][b]
-        else:
-            hist = {int(k): v for k, v in overload_data["counts"].items() if int(k) > 0}
-            count_sum = sum([k * v for k, v in hist.items()])
+        count_sum = int((counts * pixels).sum())
 
         average_to_peak = 1
         if mosaicity_correction:
             # Adjust for the detector count rate correction
             if self._sigma_m:
-                delta_z = self._oscillation / self._sigma_m / math.sqrt(2)
-                average_to_peak = (
-                    math.sqrt(math.pi) * delta_z * math.erf(delta_z)
-                    + math.exp(-(delta_z**2))
-                    - 1
-                ) / delta_z**2
+                average_to_peak = _average_to_peak_ratio(
+                    self._oscillation, self._sigma_m
+                )
                 info("Average-to-peak intensity ratio: %f", average_to_peak)
 
-        scale = 100 * overload_data["scale_factor"] / average_to_peak
+        scale = 100 * float(overload_data["scale_factor"]) / average_to_peak
         info("Determined scale factor for intensities as %f", scale)
 
         debug(
             "intensity histogram: { %s }",
             ", ".join([f"{k:d}:{hist[k]:d}" for k in sorted(hist)]),
         )
-        max_count = max(hist.keys())
+        max_count = int(counts.max())
         hist_max = max_count * scale
         hist_granularity, hist_format = 1, ".0f"
         if hist_max < 50:
             hist_granularity, hist_format = 2, ".1f"
         if hist_max < 15:
             hist_granularity, hist_format = 10, ".1f"
-        rescaled_hist = {}
-        for x in hist.keys():
-            rescaled = round(x * scale * hist_granularity)
-            if rescaled > 0:
-                rescaled_hist[rescaled] = hist[x] + rescaled_hist.get(rescaled, 0)
-        hist = rescaled_hist
+        # Merge the pixel counts of all the count values that share a rescaled bin.
+        rescaled = np.rint(counts * scale * hist_granularity).astype(np.int64)
+        positive = rescaled > 0
+        rescaled_pixels = np.bincount(rescaled[positive], weights=pixels[positive])
+        (occupied,) = rescaled_pixels.nonzero()
+        hist = dict(
+            zip(occupied.tolist(), rescaled_pixels[occupied].astype(np.int64).tolist())
+        )
         debug(
             "rescaled histogram: { %s }",
             ", ".join(
@@ -657,7 +741,10 @@ class Screen19:
             ),
         )
 
-        screen19.plot_intensities(hist, 1 / hist_granularity)
+        if self.params.maximum_flux.gnuplot:
+            screen19.plot_intensities(hist, 1 / hist_granularity)
+        else:
+            screen19.ascii_histogram(hist, 1 / hist_granularity)
 
         linear_response_limit = 100 * self.params.maximum_flux.trusted_range_correction
         marginal_limit = max(70, linear_response_limit)
@@ -812,7 +899,6 @@ class Screen19:
 
         self.refls.as_file(self.params.dials_index.output.reflections)
         self.expts.as_file(self.params.dials_index.output.experiments)
-        self.refls.as_file(self.params.dials_index.output.reflections)
         info(
             "Found primitive solution: %s %s using %s reflections\n"
             "Indexed experiments and reflections saved as %s, %s\n"
@@ -846,6 +932,9 @@ class Screen19:
     def _refine(self) -> None:
         """
         Run `dials.refine` on the results of indexing.
+
+        The indexed experiment list and reflection table files are overwritten with
+        the refined versions, so that they remain consistent with each other.
         """
         dials_start = timeit.default_timer()
         info("\nRefining...")
@@ -858,6 +947,9 @@ class Screen19:
             warning("dials.refine failed: %d\nGiving up.\n", e)
             sys.exit(1)
 
+        self.expts.as_file(self.params.dials_index.output.experiments)
+        self.refls.as_file(self.params.dials_index.output.reflections)
+
         info("Successfully refined (%.1f sec)", timeit.default_timer() - dials_start)
 
     def _create_profile_model(self) -> bool:
@@ -871,33 +963,37 @@ class Screen19:
             Boolean value indicating whether it was possible to determine a profile
             model from the data.
         """
+        dials_start = timeit.default_timer()
         info("\nCreating profile model...")
-        command = [
-            "dials.create_profile_model",
-            self.params.dials_index.output.experiments,
-            self.params.dials_index.output.reflections,
-            f"output = {self.params.dials_index.output.experiments}",
-        ]
 
-        start = timeit.default_timer()
-        result = procrunner.run(command, print_stdout=False)
+        # Use some choice fillets from dials.create_profile_model
+        refls = self.refls.select(self.refls.get_flags(self.refls.flags.indexed))
+        refls.compute_zeta_multi(self.expts)
+        refls.compute_d(self.expts)
 
-        debug("result = %s", screen19.prettyprint_procrunner(result))
         self._sigma_m = None
-        if result.returncode == 0:
-            db = ExperimentList.from_file(self.params.dials_index.output.experiments)[0]
-            self._oscillation = db.imageset.get_scan().get_oscillation()[1]
-            self._sigma_m = db.profile.sigma_m()
-            info(
-                "%d images, %s° oscillation, σ_m=%.3f°",
-                db.imageset.get_scan().get_num_images(),
-                str(self._oscillation),
-                self._sigma_m,
+        try:
+            self.expts = ProfileModelFactory.create(
+                self.params.dials_create_profile, self.expts, refls
             )
-            info("Successfully completed (%.1f sec)", timeit.default_timer() - start)
-            return True
-        warning("Failed with exit code %d", result.returncode)
-        return False
+        except (RuntimeError, Sorry) as e:
+            warning("Failed: %s", str(e))
+            return False
+
+        self.expts.as_file(self.params.dials_index.output.experiments)
+
+        expt = self.expts[0]
+        scan = expt.imageset.get_scan()
+        self._oscillation = scan.get_oscillation()[1]
+        self._sigma_m = expt.profile.sigma_m()
+        info(
+            "%d images, %s° oscillation, σ_m=%.3f°",
+            scan.get_num_images(),
+            str(self._oscillation),
+            self._sigma_m,
+        )
+        info("Successfully completed (%.1f sec)", timeit.default_timer() - dials_start)
+        return True
 
     def _integrate(self) -> None:
         """Run `dials.integrate` to integrate reflection intensities."""
@@ -952,14 +1048,13 @@ class Screen19:
             command = ["dials.refine_bravais_settings", experiments, reflections]
 
             start = timeit.default_timer()
-            result = procrunner.run(command, print_stdout=False)
+            result = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
 
-            debug("result = %s", screen19.prettyprint_procrunner(result))
+            debug("result = %s", screen19.LazyPrettyPrint(result))
             if result.returncode == 0:
-                m = re.search(
-                    r"[-+]{3,}\n[^\n]*\n[-+|]{3,}\n(.*\n)*[-+]{3,}",
-                    result.stdout.decode("utf-8"),
-                )
+                m = _bravais_table.search(result.stdout.decode("utf-8"))
                 if m:
                     info(m.group(0))
                 else:
@@ -971,7 +1066,11 @@ class Screen19:
                     "Successfully completed (%.1f sec)", timeit.default_timer() - start
                 )
             else:
-                warning("Failed with exit code %d", result.returncode)
+                warning(
+                    "Failed with exit code %d\n%s",
+                    result.returncode,
+                    result.stderr.decode("utf-8", "replace"),
+                )
                 sys.exit(1)
 
     else:
@@ -1017,38 +1116,34 @@ class Screen19:
                 timeit.default_timer() - dials_start,
             )
 
-    def _report(
-        self, experiments: ExperimentList, reflections: flex.reflection_table
-    ) -> None:
+    def _report(self, experiments: str, reflections: str) -> None:
         """
         Run `dials.report` on an experiment list and reflection table.
 
         Args:
-            experiments:  An experiment list.
-            reflections:  The corresponding reflection table.
+            experiments:  Path to an experiment list file.
+            reflections:  Path to the corresponding reflection table file.
         """
+        dials_start = timeit.default_timer()
         info("\nCreating report...")
-        command = ["dials.report", experiments, reflections]
 
-        start = timeit.default_timer()
-        result = procrunner.run(command, print_stdout=False)
-
-        debug("result = %s", screen19.prettyprint_procrunner(result))
-        if result.returncode == 0:
-            info("Successfully completed (%.1f sec)", timeit.default_timer() - start)
-        #     if sys.stdout.isatty():
-        #       info("Trying to start browser")
-        #       try:
-        #         import subprocess
-        #         d = dict(os.environ)
-        #         d["LD_LIBRARY_PATH"] = ""
-        #         subprocess.Popen(["xdg-open", "dials-report.html"], env=d)
-        #       except Exception as e:
-        #         debug("Could not open browser\n%s", str(e))
-        else:
-            warning("Failed with exit code %d", result.returncode)
+        # Use some choice fillets from dials.report
+        try:
+            analyser = Analyser(
+                self.params.dials_report,
+                grid_size=self.params.dials_report.grid_size,
+                centroid_diff_max=self.params.dials_report.centroid_diff_max,
+            )
+            analyser(
+                flex.reflection_table.from_file(reflections),
+                ExperimentList.from_file(experiments),
+            )
+        except (OSError, RuntimeError, Sorry) as e:
+            warning("dials.report failed: %s\nGiving up.", str(e))
             sys.exit(1)
 
+        info("Successfully completed (%.1f sec)", timeit.default_timer() - dials_start)
+
     def run(
         self,
         args: Optional[List[str]] = None,
@@ -1170,7 +1265,7 @@ class Screen19:
         else:
             self._wilson_calculation()
 
-            experiments = self.params.dials_create_profile.output
+            experiments = self.params.dials_index.output.experiments
             reflections = self.params.dials_index.output.reflections
 
         # This is a hacky check but should work for as long as DIALS 2.0 is supported.
@@ -36,7 +36,7 @@ setup(
         ],
         "libtbx.precommit": ["screen19 = screen19"],
     },
-    install_requires=['typing;python_version<"3.5"', "procrunner"],
+    install_requires=["ijson"],
     license="BSD license",
     long_description="\n\n".join([readme, changelog_header, changelog]),
     include_package_data=True,
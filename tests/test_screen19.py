@@ -1,7 +1,12 @@
+import json
+import logging
+from decimal import Decimal
+
 import pytest
 
-from screen19 import minimum_exposure
-from screen19.screen import Screen19
+import screen19
+from screen19 import ascii_histogram, minimum_exposure
+from screen19.screen import Screen19, _read_overload_data
 
 # A list of tuples of example sys.argv[1:] cases and associated image count.
 import_checks = [
@@ -32,6 +37,80 @@ def test_minimum_exposure_help_does_not_crash():
     minimum_exposure.run(args=[])
 
 
+def test_ascii_histogram(caplog, monkeypatch):
+    with caplog.at_level(logging.INFO, logger="dials.screen19"):
+        ascii_histogram({1: 10, 50: 1000, 100: 1}, 1)
+
+    assert "Pixel intensity distribution" in caplog.text
+    rows = [
+        record.getMessage().split(" |", 1)[1]
+        for record in caplog.records
+        if " |" in record.getMessage()
+    ]
+    top, bottom = rows[0], rows[-1]
+    width = len(bottom)
+
+    # Every bin is drawn on the bottom row, x=1 near the left, x=100 in the last column.
+    left, middle, right = (i for i, c in enumerate(bottom) if c == "*")
+    assert left <= 2
+    assert abs(middle - width // 2) <= 1
+    assert right == width - 1
+    # Only the largest bin reaches the top row.
+    assert [i for i, c in enumerate(top) if c == "*"] == [middle]
+    # The single-count bin appears only in the bottom row.
+    assert all(row[right] == " " for row in rows[:-1])
+    # With a logarithmic scale, the 10-count bin is well above the bottom row.
+    assert 1 < sum(row[left] == "*" for row in rows) < len(rows)
+
+    # A terminal too narrow for the y-axis labels still gets a (minimal) plot.
+    monkeypatch.setattr(screen19, "terminal_size", lambda: (12, 4))
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger="dials.screen19"):
+        ascii_histogram({1: 1234567890, 100: 1}, 1)
+
+    assert "*" in caplog.text
+
+
+def test_read_overload_data_bins(tmp_path):
+    overload = tmp_path / "overload.json"
+    overload.write_text(
+        json.dumps(
+            {
+                "scale_factor": 0.5,
+                "overload_limit": 100,
+                "bin_count": 4,
+                "bins": [7, 0, 3, 4, 9],
+                # Ignored in favour of the bins.
+                "counts": {"1": 2, "2": 5},
+            }
+        )
+    )
+
+    hist, scalars = _read_overload_data(str(overload))
+
+    assert hist == {0: 7, 2: 3, 3: 4}
+    assert scalars == {
+        "scale_factor": Decimal("0.5"),
+        "overload_limit": 100,
+        "bin_count": 4,
+    }
+    # Integer fields are not converted to floats.
+    assert type(scalars["overload_limit"]) is int
+    assert type(scalars["bin_count"]) is int
+
+
+def test_read_overload_data_counts(tmp_path):
+    overload = tmp_path / "overload.json"
+    overload.write_text(
+        json.dumps({"scale_factor": 0.25, "counts": {"0": 1000, "3": 20, "12": 1}})
+    )
+
+    hist, scalars = _read_overload_data(str(overload))
+
+    assert hist == {3: 20, 12: 1}
+    assert scalars == {"scale_factor": Decimal("0.25")}
+
+
 @pytest.mark.parametrize("import_checks", import_checks)
 def test_screen19_inputs(dials_data, tmpdir, import_checks):
     """Test various valid input argument styles"""